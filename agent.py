@@ -1,77 +1,102 @@
-import random
+import numpy as np
+
+from agent_kernels import choose_attackers, choose_target, play_turn
 
 
 
 class BaseAgent():
+    # whether continue_attack always returns True, in which case battles
+    # can be resolved without consulting the agent between rounds
+    always_continue_attack = False
+
+    # whether play_turn is implemented, in which case headless games can
+    # play a whole turn at once instead of going through each step
+    has_compiled_turn = False
+
+    __slots__ = ('game', 'id', 'n_units', 'cards_by_type')
+
     def __init__(self, game, id, n_units):
         self.game = game
         self.id = id
         self.n_units = n_units
-        self.cards = []
+        self.cards_by_type = [[], [], []]
 
-    def reinforce(self, n_reinforcements):
+    def reinforce(self, n_reinforcements, player_nodes):
         raise NotImplementedError('not implemented')
 
-    def select_attack_target(self):
+    def select_attack_target(self, player_nodes):
         raise NotImplementedError('not implemented')
 
     def continue_attack(self, n_units_attack, n_units_defend):
         raise NotImplementedError('not implemented')
 
+    def play_turn(self, n_reinforcements, player_nodes):
+        raise NotImplementedError('not implemented')
+
     def move(self):
         raise NotImplementedError('not implemented')
 
 
 
 class DefaultAgent(BaseAgent):
-    def reinforce(self, n_reinforcements):
-        G = self.game._graph
+    always_continue_attack = True
+    has_compiled_turn = True
+    attack_prob = 0.5
 
-        # get list of all nodes occupied by player
-        player_nodes = [v for v in G.nodes if G.nodes[v]['player_id'] == self.id]
+    __slots__ = ()
 
-        # determine threat level of each node
-        weights = [self.game.get_enemy_neighbors(v) for v in player_nodes]
-        weights = [sum(G.nodes[v]['n_units'] for v in nodes) for nodes in weights]
+    def reinforce(self, n_reinforcements, player_nodes):
+        game = self.game
 
-        # place reinforcements, weighted by threat level
-        placements = random.choices(player_nodes, weights=weights, k=n_reinforcements)
-        node_updates = set(placements)
+        # determine threat level of each node as the number of enemy units
+        # adjacent to it, using a single pass over the adjacency
+        enemy_units = np.where(game.player_id[game.indices] != self.id, game.n_units[game.indices], 0)
+        enemy_units = np.concatenate([[0], np.cumsum(enemy_units)])
+        weights = enemy_units[game.indptr[player_nodes + 1]] - enemy_units[game.indptr[player_nodes]]
 
-        for v in placements:
-            G.nodes[v]['n_units'] += 1
+        # place reinforcements, weighted by threat level, or uniformly
+        # if no node is threatened
+        weights = weights.astype(np.float64)
 
-        return node_updates
+        if weights.sum() == 0:
+            weights[:] = 1
 
-    def select_attack_target(self):
-        G = self.game._graph
+        counts = game._rng.multinomial(n_reinforcements, weights / weights.sum())
+        placed = np.flatnonzero(counts)
 
-        # get list of all nodes occupied by player
-        player_nodes = [v for v in G.nodes if G.nodes[v]['player_id'] == self.id]
+        game.n_units[player_nodes[placed]] += counts[placed]
 
-        # perform an attack from each occupied node with some probability
-        attack_prob = 0.5
-        valid_nodes = [v for v in player_nodes if G.nodes[v]['n_units'] > 1]
+        return player_nodes[placed]
 
-        for v in valid_nodes:
-            # determine whether this node has enemy neighbors
-            enemy_neighbors = self.game.get_enemy_neighbors(v)
+    def select_attack_target(self, player_nodes):
+        game = self.game
 
-            if len(enemy_neighbors) == 0:
-                continue
+        # choose nodes to attack from with some probability
+        u_attack, u_target = game._rng.random((2, len(player_nodes)))
 
-            # decide whether to attack from this node
-            if random.uniform(0, 1) < attack_prob:
-                continue
+        attackers = choose_attackers(player_nodes, game.n_units, game.has_enemy_nbr, self.attack_prob, u_attack)
+
+        for i in attackers.tolist():
+            # select a target among the enemy neighbors that remain after
+            # the attacks made so far
+            v = player_nodes[i]
+            w = choose_target(v, game.player_id, game.indptr, game.indices, u_target[i])
 
-            # select a random neighbor to attack
-            w = random.choice(enemy_neighbors)
+            if w < 0:
+                continue
 
             # generate source-target pair for attack
-            yield v, w
+            yield int(v), w
 
     def continue_attack(self, n_units_attack, n_units_defend):
         return True
 
     def move(self):
-        pass
\ No newline at end of file
+        pass
+
+    def play_turn(self, n_reinforcements, player_nodes):
+        game = self.game
+
+        # reinforce and attack in compiled code, returning an event log
+        # of (source, target, defender, success) for each attack
+        return play_turn(player_nodes, self.id, n_reinforcements, game.player_id, game.n_units, game.has_enemy_nbr, game.indptr, game.indices, self.attack_prob)
\ No newline at end of file
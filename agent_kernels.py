@@ -0,0 +1,167 @@
+from numba import njit
+import numpy as np
+
+from battle import resolve_battle
+
+
+
+@njit(cache=True)
+def choose_attackers(player_nodes, n_units, has_enemy_nbr, attack_prob, u_attack):
+    attackers = np.empty(len(player_nodes), np.int64)
+    n_attackers = 0
+
+    for i in range(len(player_nodes)):
+        v = player_nodes[i]
+
+        # skip nodes that don't have enough units or any enemy neighbors
+        if n_units[v] <= 1 or not has_enemy_nbr[v]:
+            continue
+
+        # decide whether to attack from this node
+        if u_attack[i] < attack_prob:
+            continue
+
+        attackers[n_attackers] = i
+        n_attackers += 1
+
+    # return positions in player_nodes, so that each attacker keeps its
+    # own draw for choosing a target
+    return attackers[:n_attackers]
+
+
+
+@njit(cache=True)
+def choose_target(v, player_id, indptr, indices, u):
+    # count enemy neighbors as of now, since earlier attacks this turn
+    # may have captured some of them
+    n_enemies = 0
+
+    for j in range(indptr[v], indptr[v + 1]):
+        if player_id[indices[j]] != player_id[v]:
+            n_enemies += 1
+
+    # select a random neighbor to attack, if any remain
+    k = int(u * n_enemies)
+
+    for j in range(indptr[v], indptr[v + 1]):
+        w = indices[j]
+
+        if player_id[w] != player_id[v]:
+            if k == 0:
+                return w
+
+            k -= 1
+
+    return -1
+
+
+
+@njit(cache=True)
+def _has_enemy_nbr_at(v, player_id, indptr, indices):
+    for j in range(indptr[v], indptr[v + 1]):
+        if player_id[indices[j]] != player_id[v]:
+            return True
+
+    return False
+
+
+
+@njit(cache=True)
+def play_turn(player_nodes, pid, n_reinforcements, player_id, n_units, has_enemy_nbr, indptr, indices, attack_prob):
+    n = len(player_nodes)
+
+    # determine threat level of each node
+    weights = np.zeros(n)
+
+    for i in range(n):
+        v = player_nodes[i]
+
+        for j in range(indptr[v], indptr[v + 1]):
+            w = indices[j]
+
+            if player_id[w] != pid:
+                weights[i] += n_units[w]
+
+    # place reinforcements, weighted by threat level, or uniformly
+    # if no node is threatened
+    if weights.sum() == 0:
+        weights[:] = 1
+
+    cdf = np.cumsum(weights)
+
+    for _ in range(n_reinforcements):
+        i = np.searchsorted(cdf, np.random.random() * cdf[-1], side='right')
+        n_units[player_nodes[i]] += 1
+
+    # choose nodes to attack from with some probability
+    u_attack = np.random.random(n)
+    u_target = np.random.random(n)
+    attackers = choose_attackers(player_nodes, n_units, has_enemy_nbr, attack_prob, u_attack)
+
+    # perform attacks, recording (source, target, defender, success)
+    events = np.empty((len(attackers), 4), np.int64)
+    n_events = 0
+
+    for i in attackers:
+        v = player_nodes[i]
+        w = choose_target(v, player_id, indptr, indices, u_target[i])
+
+        # skip nodes whose enemy neighbors were all captured this turn
+        if w < 0:
+            continue
+
+        # do battle with all but one unit of the attacking node
+        n_units_attack, n_units_defend = resolve_battle(n_units[v] - 1, n_units[w])
+        n_units[v] = 1
+
+        events[n_events, 0] = v
+        events[n_events, 1] = w
+        events[n_events, 2] = player_id[w]
+        events[n_events, 3] = n_units_defend == 0
+        n_events += 1
+
+        # if defender won, return defending units to their node
+        if n_units_defend > 0:
+            n_units[w] = n_units_defend
+            continue
+
+        # if attacker won, move attacking units into defending node
+        player_id[w] = pid
+        n_units[w] = n_units_attack
+
+        # update enemy neighbor flags around the captured node
+        has_enemy_nbr[w] = _has_enemy_nbr_at(w, player_id, indptr, indices)
+
+        for j in range(indptr[w], indptr[w + 1]):
+            u = indices[j]
+            has_enemy_nbr[u] = _has_enemy_nbr_at(u, player_id, indptr, indices)
+
+    return events[:n_events]
+
+
+
+# compile on import so that the first turn doesn't pay for it
+choose_attackers(
+    np.zeros(1, np.int32),
+    np.zeros(1, np.int32),
+    np.zeros(1, np.bool_),
+    0.5,
+    np.zeros(1))
+
+choose_target(
+    np.int32(0),
+    np.zeros(1, np.int8),
+    np.zeros(2, np.int32),
+    np.zeros(0, np.int32),
+    0.0)
+
+play_turn(
+    np.zeros(1, np.int32),
+    1,
+    0,
+    np.ones(1, np.int8),
+    np.ones(1, np.int32),
+    np.zeros(1, np.bool_),
+    np.zeros(2, np.int32),
+    np.zeros(0, np.int32),
+    0.5)
\ No newline at end of file
@@ -0,0 +1,64 @@
+from numba import njit
+import itertools
+import numpy as np
+
+
+
+def _create_outcome_cdf():
+    # enumerate every roll of 1-3 attack dice against 1-2 defend dice and
+    # tabulate the cumulative distribution of attacker losses per round
+    cdf = np.zeros((3, 2, 3))
+
+    for n_dice_attack, n_dice_defend in itertools.product([1, 2, 3], [1, 2]):
+        counts = np.zeros(3)
+
+        for dice in itertools.product(range(1, 7), repeat=n_dice_attack + n_dice_defend):
+            dice_attack = sorted(dice[:n_dice_attack], reverse=True)
+            dice_defend = sorted(dice[n_dice_attack:], reverse=True)
+            n_losses_attack = sum(r_atk <= r_def for r_atk, r_def in zip(dice_attack, dice_defend))
+            counts[n_losses_attack] += 1
+
+        cdf[n_dice_attack - 1, n_dice_defend - 1] = np.cumsum(counts) / counts.sum()
+
+    return cdf
+
+
+
+OUTCOME_CDF = _create_outcome_cdf()
+
+
+
+@njit(cache=True)
+def resolve_battle(n_units_attack, n_units_defend):
+    # do battle until one side wins
+    while n_units_attack > 0 and n_units_defend > 0:
+        n_dice_attack = min(n_units_attack, 3)
+        n_dice_defend = min(n_units_defend, 2)
+        n_pairs = min(n_dice_attack, n_dice_defend)
+
+        # draw the outcome of the round from its precomputed distribution
+        # instead of rolling and comparing individual dice
+        cdf = OUTCOME_CDF[n_dice_attack - 1, n_dice_defend - 1]
+        u = np.random.random()
+        n_losses_attack = 0
+
+        while u >= cdf[n_losses_attack]:
+            n_losses_attack += 1
+
+        n_units_attack -= n_losses_attack
+        n_units_defend -= n_pairs - n_losses_attack
+
+    return n_units_attack, n_units_defend
+
+
+
+@njit(cache=True)
+def seed_kernels(seed):
+    # seed the random number generator shared by all compiled kernels,
+    # which is separate from numpy's global generator
+    np.random.seed(seed)
+
+
+
+# compile on import so that the first battle doesn't pay for it
+resolve_battle(1, 1)
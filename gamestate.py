@@ -1,14 +1,11 @@
 from collections import namedtuple
 import itertools
-import matplotlib as mpl
-import matplotlib.colors
-import matplotlib.cm as cm
-import matplotlib.pyplot as plt
 import networkx as nx
 import networkx.algorithms
-import random
+import numpy as np
 
 from agent import DefaultAgent
+from battle import resolve_battle, seed_kernels
 from graph import GridGraph
 
 
@@ -23,10 +20,59 @@ Card = namedtuple('Card', ['node', 'type'])
 
 
 
+Frame = namedtuple('Frame', ['player_id', 'n_units', 'updated', 'text'])
+
+
+
+RANDOM_POOL_SIZE = 65536
+
+
+
+_mpl = None
+
+
+
+def _lazy_mpl():
+    # import matplotlib on first use, so that headless games don't pay
+    # for backend initialization
+    global _mpl
+
+    if _mpl == None:
+        import matplotlib as mpl
+        import matplotlib.cm
+        import matplotlib.colors
+        import matplotlib.pyplot
+
+        _mpl = mpl
+
+    return _mpl
+
+
+
 class GameState():
-    def __init__(self, grid_size=8, grid_remove=0.25, grid_perturb=0.25, n_players=2, n_starting_units=50):
+    __slots__ = (
+        'player_id', 'n_units', 'has_enemy_nbr', 'pos', 'indptr', 'indices',
+        '_rng', '_graph', '_players', '_nodes_by_player',
+        '_cards', '_discards', '_current_card_bonus', '_d6', '_d6_i',
+        '_frames', '_full_frames', '_fig', '_ax', '_node_artist', '_text_artist',
+        '_player_colors', '_edgecolor', '_highlight', '_edgecolors', '_updated',
+        '_n_units_rendered', '_player_id_rendered'
+    )
+
+    def __init__(self, grid_size=8, grid_remove=0.25, grid_perturb=0.25, n_players=2, n_starting_units=50, topology=None, render_enabled=True, full_frames=True, seed=None):
+        # derive independent seeds for the topology, this game and the
+        # compiled kernels if a seed is given
+        if seed == None:
+            topology_seed = rng_seed = kernel_seed = None
+        else:
+            topology_seed, rng_seed, kernel_seed = (int(s.generate_state(1)[0]) for s in np.random.SeedSequence(seed).spawn(3))
+
+        # initialize graph topology unless one was provided
+        if topology == None:
+            topology = GridGraph(grid_size, grid_remove, grid_perturb, seed=topology_seed, cache=False).create()
+
         # validate arguments
-        n_nodes = grid_size ** 2
+        n_nodes = len(topology.pos)
 
         if n_nodes < n_players:
             raise ValueError('Not enough grid points for all players')
@@ -34,40 +80,55 @@ class GameState():
         if n_players * n_starting_units < n_nodes:
             raise ValueError('Players do not have enough starting units to occupy the entire grid')
 
-        # initialize figure
-        self._fig = plt.figure(figsize=(12, 12))
+        # initialize frame counter, whether to record every step of a turn
         self._frames = 0
+        self._full_frames = full_frames
+
+        # initialize random number generators, note that the kernel
+        # generator is shared by all games in a process
+        self._rng = np.random.default_rng(rng_seed)
+
+        if kernel_seed != None:
+            seed_kernels(kernel_seed)
+
+        # initialize graph, node state arrays
+        G = topology.graph
+        N = n_nodes
 
-        # initialize graph
-        G = GridGraph(grid_size, grid_remove, grid_perturb).create()
+        self.player_id = np.zeros(N, np.int8)
+        self.n_units = np.zeros(N, np.int32)
+        # copy topology arrays, which may be shared with other games
+        self.pos = topology.pos.copy()
+        self.indptr = topology.indptr.copy()
+        self.indices = topology.indices.copy()
 
         # initialize cards
         card_types = [CARD_TYPE_INFANTRY, CARD_TYPE_CAVALRY, CARD_TYPE_ARTILLERY]
         cards = [Card(v, t) for v, t in zip(G.nodes, itertools.cycle(card_types))]
-        random.shuffle(cards)
+        self._rng.shuffle(cards)
 
         # initialize players
         players = [DefaultAgent(self, i + 1, n_starting_units) for i in range(n_players)]
 
-        # assign nodes randomly to players
-        unclaimed_nodes = list(G.nodes)
-        random.shuffle(unclaimed_nodes)
+        # assign nodes randomly to players, dealing them out in turn from
+        # a random permutation with one unit each
+        unclaimed_nodes = self._rng.permutation(N)
+        nodes_by_player = {}
 
-        for i, v in enumerate(unclaimed_nodes):
-            player = players[i % n_players]
-            G.nodes[v]['player_id'] = player.id
-            G.nodes[v]['n_units'] += 1
-            player.n_units -= 1
+        for i, player in enumerate(players):
+            player_nodes = unclaimed_nodes[i::n_players]
 
-        # reinforce each player's territories randomly
-        for player in players:
-            # get list of nodes occupied by player
-            player_nodes = [v for v in G.nodes if G.nodes[v]['player_id'] == player.id]
+            self.player_id[player_nodes] = player.id
+            self.n_units[player_nodes] = 1
+            player.n_units -= len(player_nodes)
+            nodes_by_player[player.id] = set(player_nodes.tolist())
 
-            while player.n_units > 0:
-                v = random.choice(player_nodes)
-                G.nodes[v]['n_units'] += 1
-                player.n_units -= 1
+            # distribute remaining units uniformly over occupied nodes
+            n_player_nodes = len(player_nodes)
+            counts = self._rng.multinomial(max(player.n_units, 0), np.full(n_player_nodes, 1 / n_player_nodes))
+
+            self.n_units[player_nodes] += counts
+            player.n_units -= int(counts.sum())
 
         # save attributes
         self._graph = G
@@ -75,151 +136,235 @@ class GameState():
         self._cards = cards
         self._discards = []
         self._players = players
+        self._nodes_by_player = nodes_by_player
 
-    def render(self, args):
-        # unpack arguments
-        node_updates, text = args
+        # determine which nodes have enemy neighbors in one pass over
+        # the adjacency
+        src = np.repeat(np.arange(N), np.diff(self.indptr))
+        is_enemy_edge = self.player_id[self.indices] != self.player_id[src]
 
-        # print frame number
-        print('rendering frame %d' % (self._frames))
-        self._frames += 1
+        self.has_enemy_nbr = np.bincount(src[is_enemy_edge], minlength=N) > 0
 
-        # determine graph attributes
-        G = self._graph
-        pos = {v: G.nodes[v]['pos'] for v in G.nodes}
-        sizes = [(300 + 300 * G.nodes[v]['n_units']) for v in G.nodes]
-        colors = [G.nodes[v]['player_id'] / len(self._players) for v in G.nodes]
-        labels = {v: G.nodes[v]['n_units'] for v in G.nodes}
+        # initialize an empty pool of pre-drawn dice rolls, which is only
+        # filled once dice are actually rolled
+        self._d6 = np.zeros(0, np.int8)
+        self._d6_i = 0
+
+        # initialize figure if rendering is enabled
+        self._fig = None
+
+        if render_enabled:
+            self._init_plot()
 
-        # highlight updated nodes
-        edgecolors = [('r' if v in node_updates else 'w') for v in G.nodes]
+    def _init_plot(self):
+        mpl = _lazy_mpl()
+        G = self._graph
 
-        # clear figure
-        plt.clf()
+        # create a single figure and axes which are reused by every frame
+        self._fig = mpl.pyplot.figure(figsize=(12, 12))
+        self._ax = ax = self._fig.add_subplot(111)
 
-        # create colormap for graph, legend
+        # create colormap for graph, legend, with one color per player
         norm = mpl.colors.Normalize(vmin=1, vmax=len(self._players))
-        cmap = plt.get_cmap('Accent')
-        smap = cm.ScalarMappable(norm=norm, cmap=cmap)
-
-        # draw graph
-        nx.draw_networkx(
-            G,
-            pos=pos,
-            with_labels=False,
-            node_size=sizes,
-            node_color=colors,
-            labels=labels,
-            cmap=cmap,
-            linewidths=2.0,
-            edgecolors=edgecolors)
+        cmap = mpl.pyplot.get_cmap('Accent')
+        smap = mpl.cm.ScalarMappable(norm=norm, cmap=cmap)
 
-        # plot dummy points for legend
-        xmin, xmax = plt.xlim()
-        ymin, ymax = plt.ylim()
+        self._player_colors = smap.to_rgba(np.arange(1, len(self._players) + 1))
+
+        # create edge colors, updated nodes are highlighted per frame
+        self._edgecolor = mpl.colors.to_rgba('w')
+        self._highlight = mpl.colors.to_rgba('r')
+        self._edgecolors = np.tile(self._edgecolor, (len(self.pos), 1))
+        self._updated = np.zeros(0, np.int32)
+        self._n_units_rendered = None
+        self._player_id_rendered = None
+
+        # draw graph once, frames only update node properties
+        pos = {v: self.pos[v] for v in G.nodes}
 
+        nx.draw_networkx_edges(G, pos=pos, ax=ax)
+        self._node_artist = nx.draw_networkx_nodes(G, pos=pos, ax=ax, linewidths=2.0)
+        self._node_artist.set_edgecolors(self._edgecolors)
+
+        # fix axis limits from node positions
+        xmin, ymin = self.pos.min(axis=0) - 0.5
+        xmax, ymax = self.pos.max(axis=0) + 0.5
+
+        ax.set_xlim(xmin, xmax)
+        ax.set_ylim(ymin, ymax)
+        ax.set_axis_off()
+
+        # plot dummy points for legend
         for player in self._players:
-            color = smap.to_rgba(player.id)
+            color = self._player_colors[player.id - 1]
             label = 'Player %d' % (player.id)
-            plt.plot([-10], [-10], 'o', color=color, label=label, markersize=10)
-
-        plt.xlim(xmin, xmax)
-        plt.ylim(ymin, ymax)
+            ax.plot([-10], [-10], 'o', color=color, label=label, markersize=10)
 
         # draw legend
-        plt.legend(loc='center left', bbox_to_anchor=(1.0, 0.5))
+        ax.legend(loc='center left', bbox_to_anchor=(1.0, 0.5))
+
+        # create text annotation
+        self._text_artist = ax.text(xmin, ymax * 1.05, '', fontsize='x-large')
+
+    def init_render(self):
+        # the graph is already drawn, return the artists updated by each frame
+        return self._node_artist, self._text_artist
+
+    def render(self, frame):
+        # unpack arguments
+        player_id, n_units, updated, text = frame
+
+        # print frame number
+        print('rendering frame %d' % (self._frames))
+        self._frames += 1
+
+        # update node sizes and colors only if they changed since the
+        # previous frame, which they don't before an attack is resolved
+        if not np.array_equal(n_units, self._n_units_rendered):
+            self._node_artist.set_sizes(300 + 300 * n_units)
+            self._n_units_rendered = n_units
+
+        if not np.array_equal(player_id, self._player_id_rendered):
+            self._node_artist.set_facecolors(self._player_colors[player_id - 1])
+            self._player_id_rendered = player_id
+
+        # highlight updated nodes, clearing those of the previous frame
+        if not np.array_equal(updated, self._updated):
+            self._edgecolors[self._updated] = self._edgecolor
+            self._edgecolors[updated] = self._highlight
+            self._updated = updated
+
+            self._node_artist.set_edgecolors(self._edgecolors)
 
-        # draw text annotation if specified
-        if text != None:
-            plt.text(xmin, ymax * 1.05, text, fontsize='x-large')
+        # update text annotation
+        self._text_artist.set_text(text if text != None else '')
+
+        # return updated artists for blitting
+        return self._node_artist, self._text_artist
 
     def get_card_trio(self, player):
-        # generate all subsets of size three in player hand
+        # a valid trio is either one card of each type or three of a kind,
+        # remove it from the player hand if found
+        by_type = player.cards_by_type
         card_trio = None
 
-        for trio in itertools.combinations(player.cards, 3):
-            if sum(c.type for c in trio) % 3 == 0:
-                card_trio = trio
-                break
-
-        # remove card trio from player hand if found
-        if card_trio != None:
-            for c in card_trio:
-                player.cards.remove(c)
+        if all(by_type):
+            card_trio = tuple(cards.pop() for cards in by_type)
+        else:
+            for cards in by_type:
+                if len(cards) >= 3:
+                    card_trio = (cards.pop(), cards.pop(), cards.pop())
+                    break
 
         return card_trio
 
     def get_enemy_neighbors(self, v):
-        G = self._graph
-        return [w for w in G.neighbors(v) if G.nodes[v]['player_id'] != G.nodes[w]['player_id']]
+        nbrs = self.indices[self.indptr[v]:self.indptr[v + 1]]
+        return nbrs[self.player_id[nbrs] != self.player_id[v]]
+
+    def _refill_d6(self):
+        self._d6 = self._rng.integers(1, 7, size=RANDOM_POOL_SIZE, dtype=np.int8)
+        self._d6_i = 0
+
+    def _next_d6(self, n):
+        # draw n die rolls from the pool
+        if self._d6_i + n > len(self._d6):
+            self._refill_d6()
+
+        dice = self._d6[self._d6_i : self._d6_i + n].tolist()
+        self._d6_i += n
+
+        return dice
 
     def roll_dice(self, n_dice):
-        return sorted([random.randint(1, 6) for i in range(n_dice)], reverse=True)
+        dice = self._next_d6(n_dice)
 
-    def do_attack(self, attacker, v_attack, v_defend):
-        G = self._graph
+        # sort dice in descending order
+        if n_dice == 3:
+            a, b, c = dice
+            if a < b:
+                a, b = b, a
+            if b < c:
+                b, c = c, b
+            if a < b:
+                a, b = b, a
+            return a, b, c
 
+        if n_dice == 2:
+            a, b = dice
+            return (a, b) if a >= b else (b, a)
+
+        return tuple(dice)
+
+    def do_attack(self, attacker, v_attack, v_defend):
         # raise error if attacking node doesn't have enough units
-        if G.nodes[v_attack]['n_units'] == 1:
+        if self.n_units[v_attack] == 1:
             raise ValueError('Attacking node doesn\'t have enough units!')
 
         # determine the number of units available to attack and defend
-        n_units_attack = G.nodes[v_attack]['n_units'] - 1
-        n_units_defend = G.nodes[v_defend]['n_units']
+        n_units_attack = self.n_units[v_attack] - 1
+        n_units_defend = self.n_units[v_defend]
 
         # temporarily remove units from nodes
-        G.nodes[v_attack]['n_units'] -= n_units_attack
-        G.nodes[v_defend]['n_units'] -= n_units_defend
+        self.n_units[v_attack] -= n_units_attack
+        self.n_units[v_defend] -= n_units_defend
+
+        # do battle until one side wins, using the compiled battle loop
+        # if the attacker never retreats
+        if attacker.always_continue_attack:
+            n_units_attack, n_units_defend = resolve_battle(int(n_units_attack), int(n_units_defend))
 
-        # do battle until one side wins or attacker retreats
+        # otherwise do battle until one side wins or attacker retreats
         while n_units_attack > 0 and n_units_defend > 0 and attacker.continue_attack(n_units_attack, n_units_defend):
             # roll attack dice and defend dice
             dice_attack = self.roll_dice(min(n_units_attack, 3))
             dice_defend = self.roll_dice(min(n_units_defend, 2))
 
             # check each die result and remove units accordingly
-            for r_atk, r_def in zip(dice_attack, dice_defend):
-                if r_atk > r_def:
-                    n_units_attack -= 1
-                else:
-                    n_units_defend -= 1
+            n_pairs = min(len(dice_attack), len(dice_defend))
+            n_losses_attack = (dice_attack[0] <= dice_defend[0]) + (n_pairs == 2 and dice_attack[1] <= dice_defend[1])
+
+            n_units_attack -= n_losses_attack
+            n_units_defend -= n_pairs - n_losses_attack
 
         # if attacker won, move attacking units into defending node
         if n_units_defend == 0:
-            G.nodes[v_defend]['player_id'] = G.nodes[v_attack]['player_id']
-            G.nodes[v_defend]['n_units'] = n_units_attack
+            self._nodes_by_player[self.player_id[v_defend]].discard(v_defend)
+            self._nodes_by_player[self.player_id[v_attack]].add(v_defend)
+            self.player_id[v_defend] = self.player_id[v_attack]
+            self.n_units[v_defend] = n_units_attack
+
+            # update enemy neighbor flags around the captured node
+            nbrs = self.indices[self.indptr[v_defend]:self.indptr[v_defend + 1]]
+
+            for u in [v_defend, *nbrs.tolist()]:
+                self.has_enemy_nbr[u] = len(self.get_enemy_neighbors(u)) > 0
+
             return True
 
         # if defender won, return defending units to their node
         if n_units_attack == 0:
-            G.nodes[v_defend]['n_units'] += n_units_defend
+            self.n_units[v_defend] += n_units_defend
             return False
 
     def do_turn(self, i):
-        G = self._graph
-
         # get current player
         player = self._players[i]
 
         # skip turn if player was already eliminated
-        player_nodes = [v for v in G.nodes if G.nodes[v]['player_id'] == player.id]
+        player_nodes = self._nodes_by_player[player.id]
 
         if len(player_nodes) == 0:
             return
 
-        # compute reinforcements from occupied nodes
-        n_reinforcements = max(3, len(player_nodes) // 3)
+        # take a snapshot of occupied nodes for the agent to use this turn
+        player_nodes = np.fromiter(player_nodes, np.int32, len(player_nodes))
 
-        # trade cards for reinforcements if possible
-        card_trio = self.get_card_trio(player)
-
-        if card_trio != None:
-            self._discards += card_trio
-            n_reinforcements += self._current_card_bonus
-            self._current_card_bonus += 5
+        # compute reinforcements
+        n_reinforcements = self.get_reinforcements(player, player_nodes)
 
         # place reinforcements
-        node_updates = player.reinforce(n_reinforcements)
+        node_updates = player.reinforce(n_reinforcements, player_nodes)
 
         # render updated graph
         yield (node_updates, 'Player %d placed %d reinforcements' % (player.id, n_reinforcements))
@@ -227,11 +372,11 @@ class GameState():
         # perform attacks
         attack_success = False
 
-        for v, w in player.select_attack_target():
+        for v, w in player.select_attack_target(player_nodes):
             # render updated graph
             yield ([v, w], 'Player %d attacking from %s with %d units, Player %d defending from %s with %d units' % (
-                G.nodes[v]['player_id'], v, G.nodes[v]['n_units'],
-                G.nodes[w]['player_id'], w, G.nodes[w]['n_units']
+                self.player_id[v], v, self.n_units[v],
+                self.player_id[w], w, self.n_units[w]
             ))
 
             # perform attack
@@ -246,29 +391,103 @@ class GameState():
 
             yield ([v, w], text)
 
+        # finish turn
+        self.end_turn(player, attack_success)
+
+    def do_turn_summary(self, i):
+        # get current player
+        player = self._players[i]
+
+        # skip turn if player was already eliminated
+        if len(self._nodes_by_player[player.id]) == 0:
+            return
+
+        # play the whole turn, then render every node it changed at once
+        player_id = self.player_id.copy()
+        n_units = self.n_units.copy()
+
+        self.play_turn(i)
+
+        node_updates = np.flatnonzero((self.player_id != player_id) | (self.n_units != n_units))
+
+        yield (node_updates, 'Player %d finished turn with %d nodes' % (player.id, len(self._nodes_by_player[player.id])))
+
+    def get_reinforcements(self, player, player_nodes):
+        # compute reinforcements from occupied nodes
+        n_reinforcements = max(3, len(player_nodes) // 3)
+
+        # trade cards for reinforcements if possible
+        card_trio = self.get_card_trio(player)
+
+        if card_trio != None:
+            self._discards += card_trio
+            n_reinforcements += self._current_card_bonus
+            self._current_card_bonus += 5
+
+        return n_reinforcements
+
+    def end_turn(self, player, attack_success):
         # move units
         player.move()
 
         # draw card if player captured a node
         if attack_success:
-            player.cards.append(self._cards.pop())
+            card = self._cards.pop()
+            player.cards_by_type[card.type - 1].append(card)
 
         # reset discards if card deck is empty
         if len(self._cards) == 0:
             self._cards = self._discards
             self._discards = []
 
-            random.shuffle(self._cards)
+            self._rng.shuffle(self._cards)
+
+    def play_turn(self, i):
+        # get current player
+        player = self._players[i]
+
+        # play the turn step by step if the agent can't play it at once
+        if not player.has_compiled_turn:
+            for _ in self.do_turn(i):
+                pass
+            return
+
+        # skip turn if player was already eliminated
+        player_nodes = self._nodes_by_player[player.id]
+
+        if len(player_nodes) == 0:
+            return
+
+        # take a snapshot of occupied nodes for the agent to use this turn
+        player_nodes = np.fromiter(player_nodes, np.int32, len(player_nodes))
+
+        # play reinforcements and attacks
+        n_reinforcements = self.get_reinforcements(player, player_nodes)
+        events = player.play_turn(n_reinforcements, player_nodes)
+
+        # update occupied nodes from captures
+        attack_success = False
+
+        for v, w, defender_id, success in events.tolist():
+            if success:
+                self._nodes_by_player[defender_id].discard(w)
+                self._nodes_by_player[player.id].add(w)
+                attack_success = True
+
+        # finish turn
+        self.end_turn(player, attack_success)
 
     def do_round(self):
         # perform each player's turn
         for i in range(len(self._players)):
-            yield from self.do_turn(i)
+            if self._full_frames:
+                yield from self.do_turn(i)
+            else:
+                yield from self.do_turn_summary(i)
 
     def check_winner(self):
-        # check if all nodes are occupied by a single player
-        player_ids = [self._graph.nodes[v]['player_id'] for v in self._graph.nodes]
-        player_ids = list(set(player_ids))
+        # check if only a single player still occupies any nodes
+        player_ids = [pid for pid, nodes in self._nodes_by_player.items() if len(nodes) > 0]
 
         if len(player_ids) == 1:
             return player_ids[0]
@@ -289,4 +508,22 @@ class GameState():
 
             if player_id != None:
                 yield ([], 'Player %d won!' % (player_id))
-                break
\ No newline at end of file
+                break
+
+    def play(self):
+        # play rounds without recording frames until someone has won
+        while True:
+            for i in range(len(self._players)):
+                self.play_turn(i)
+
+            player_id = self.check_winner()
+
+            if player_id != None:
+                return player_id
+
+    def simulate(self):
+        # record a compact snapshot of the game state after each step
+        for node_updates, text in self.animate():
+            updated = np.fromiter(node_updates, np.int32, len(node_updates))
+
+            yield Frame(self.player_id.copy(), self.n_units.copy(), updated, text)
\ No newline at end of file
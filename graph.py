@@ -1,12 +1,13 @@
 from collections import namedtuple
+import functools
 import itertools
-import matplotlib as mpl
-import matplotlib.colors
-import matplotlib.cm as cm
-import matplotlib.pyplot as plt
 import networkx as nx
 import networkx.algorithms
-import random
+import numpy as np
+
+
+
+Topology = namedtuple('Topology', ['graph', 'indptr', 'indices', 'pos'])
 
 
 
@@ -20,38 +21,63 @@ class BaseGraph():
 
 
 class GridGraph(BaseGraph):
-    def __init__(self, grid_size=8, grid_remove=0.25, grid_perturb=0.25):
+    def __init__(self, grid_size=8, grid_remove=0.25, grid_perturb=0.25, seed=None, cache=True):
         self.grid_size = grid_size
         self.grid_remove = grid_remove
         self.grid_perturb = grid_perturb
+        self.seed = seed
+        self.cache = cache
 
     def create(self):
-        # initialize graph
-        G = nx.generators.grid_graph(dim=[self.grid_size, self.grid_size], periodic=False)
+        # build a new random topology if no seed is given, or if the
+        # topology is not going to be reused
+        if self.seed == None or not self.cache:
+            return _create_topology(self.grid_size, self.grid_remove, self.grid_perturb, np.random.default_rng(self.seed))
+
+        # otherwise reuse the topology previously built from the same seed
+        return _build_topology(self.grid_size, self.grid_remove, self.grid_perturb, self.seed)
+
+
+
+@functools.lru_cache(maxsize=32)
+def _build_topology(grid_size, grid_remove, grid_perturb, seed):
+    # games copy the arrays they use, so the cached topology is never modified
+    return _create_topology(grid_size, grid_remove, grid_perturb, np.random.default_rng(seed))
+
+
+
+def _create_topology(grid_size, grid_remove, grid_perturb, rng):
+    # initialize graph
+    G = nx.generators.grid_graph(dim=[grid_size, grid_size], periodic=False)
+
+    # remove a random subset of nodes
+    nodes = list(G.nodes)
+    remove_idx = rng.choice(len(nodes), size=int(len(nodes) * grid_remove), replace=False)
+
+    G.remove_nodes_from(nodes[i] for i in remove_idx)
+
+    # extract the largest connected component
+    components = nx.algorithms.components.connected_components(G)
 
-        for v in G.nodes:
-            G.nodes[v]['pos'] = v
-            G.nodes[v]['player_id'] = None
-            G.nodes[v]['n_units'] = 0
+    G = G.subgraph(max(components, key=len))
 
-        # remove a random subset of nodes
-        remove_nodes = list(G.nodes)
-        random.shuffle(remove_nodes)
-        remove_nodes = remove_nodes[0 : int(len(remove_nodes) * self.grid_remove)]
+    # use grid coordinates as node positions, randomly perturbed
+    N = G.number_of_nodes()
 
-        G.remove_nodes_from(remove_nodes)
+    pos = np.array(list(G.nodes), np.float32).reshape(N, 2)
+    pos += rng.uniform(-grid_perturb, grid_perturb, size=(N, 2))
 
-        # extract the largest connected component
-        components = nx.algorithms.components.connected_components(G)
-        components = sorted(components, key=len, reverse=True)
+    # relabel nodes as 0..N-1 in the same order
+    G = nx.convert_node_labels_to_integers(G)
 
-        G = G.subgraph(components[0])
+    # build adjacency in CSR format
+    edges = np.array(G.edges, np.int32).reshape(-1, 2)
+    src = np.concatenate([edges[:, 0], edges[:, 1]])
+    dst = np.concatenate([edges[:, 1], edges[:, 0]])
+    order = np.lexsort((dst, src))
 
-        # randomly perturb the position of each node
-        for v in G.nodes:
-            x, y = G.nodes[v]['pos']
-            x += random.uniform(-self.grid_perturb, self.grid_perturb)
-            y += random.uniform(-self.grid_perturb, self.grid_perturb)
-            G.nodes[v]['pos'] = x, y
+    indptr = np.zeros(N + 1, np.int32)
+    indptr[1:] = np.cumsum(np.bincount(src, minlength=N))
+    indices = dst[order]
 
-        return G
\ No newline at end of file
+    return Topology(G, indptr, indices, pos)
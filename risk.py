@@ -1,9 +1,76 @@
 import argparse
-import matplotlib as mpl
-import matplotlib.animation
+import collections
+import itertools
+import multiprocessing
+import os
+import subprocess
+import tempfile
 import time
 
 from gamestate import GameState
+from graph import GridGraph
+
+
+
+def create_topology(args):
+    # reuse the cached topology for a fixed seed, otherwise let each game
+    # build its own
+    if args.topology_seed == None:
+        return None
+
+    return GridGraph(grid_size=args.grid_size, seed=args.topology_seed).create()
+
+
+
+def run_one(seed, args):
+    # play a game to the end without rendering, the game derives separate
+    # seeds for its own topology and random number generators
+    game = GameState(grid_size=args.grid_size, n_players=args.n_players, topology=create_topology(args), render_enabled=False, seed=seed)
+
+    return game.play()
+
+
+
+def render_video(game, frames, filename, frame_interval, dpi, frame_offset=0):
+    import matplotlib.animation
+
+    # continue frame numbering from the start of this segment
+    game._frames = frame_offset
+
+    anim = matplotlib.animation.FuncAnimation(game._fig, game.render, frames=frames, init_func=game.init_render, interval=frame_interval, blit=True)
+
+    # encode for speed rather than size, in a widely playable pixel format
+    writer = matplotlib.animation.FFMpegWriter(fps=1000 / frame_interval, codec='libx264', extra_args=['-preset', 'ultrafast', '-tune', 'zerolatency', '-pix_fmt', 'yuv420p'])
+    anim.save(filename, writer=writer, dpi=dpi)
+
+
+
+def render_video_parallel(game, frames, filename, frame_interval, dpi, n_workers):
+    import matplotlib
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # render contiguous segments of frames in separate processes,
+        # each with its own copy of the figure
+        segment_size = -(-len(frames) // n_workers)
+        segments = []
+
+        for i in range(0, len(frames), segment_size):
+            segment_filename = os.path.join(tmpdir, 'segment%d.mp4' % (i))
+            segments.append((game, frames[i:(i + segment_size)], segment_filename, frame_interval, dpi, i))
+
+        with multiprocessing.Pool(n_workers) as pool:
+            pool.starmap(render_video, segments)
+
+        # join segments into a single video without re-encoding
+        segments_filename = os.path.join(tmpdir, 'segments.txt')
+
+        with open(segments_filename, 'w') as f:
+            for segment in segments:
+                f.write('file \'%s\'\n' % (segment[2]))
+
+        ffmpeg = matplotlib.rcParams['animation.ffmpeg_path']
+
+        subprocess.run([ffmpeg, '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', segments_filename, '-c', 'copy', filename], check=True)
 
 
 
@@ -14,24 +81,67 @@ def main():
     parser.add_argument('--n-players', help='number of players', type=int, default=2)
     parser.add_argument('--n-frames', help='number of frames to render', type=int, default=100)
     parser.add_argument('--frame-interval', help='length of each frame in ms', type=int, default=500)
+    parser.add_argument('--frame-step', help='render only every k-th frame', type=int, default=1)
+    parser.add_argument('--dpi', help='resolution of the video in dots per inch', type=int, default=80)
+    parser.add_argument('--full-frames', help='render every step of each turn instead of one frame per turn', action='store_true')
+    parser.add_argument('--n-workers', help='number of processes used to render the video', type=int, default=1)
+    parser.add_argument('--topology-seed', help='seed for the map, so that every game is played on the same map', type=int)
+    parser.add_argument('--n-trials', help='number of games to play in parallel without rendering', type=int)
+    parser.add_argument('--no-video', help='simulate the game without rendering a video', action='store_true')
 
     args = parser.parse_args()
 
+    # play many independent games across all cores
+    if args.n_trials != None:
+        t0 = time.perf_counter()
+
+        with multiprocessing.Pool() as pool:
+            winners = pool.starmap(run_one, [(seed, args) for seed in range(args.n_trials)])
+
+        t1 = time.perf_counter()
+
+        # print win counts and performance metrics
+        counts = collections.Counter(winners)
+
+        for player_id in range(1, args.n_players + 1):
+            print('Player %d won %d games' % (player_id, counts[player_id]))
+
+        t = t1 - t0
+        q = args.n_trials / t
+        print('processing time: %.3f s, %.3f games / s' % (t, q))
+        return
+
     # initialize game state
-    game = GameState(grid_size=args.grid_size, n_players=args.n_players)
+    game = GameState(grid_size=args.grid_size, n_players=args.n_players, topology=create_topology(args), render_enabled=not args.no_video, full_frames=args.full_frames)
 
-    # initialize animation
     t0 = time.perf_counter()
 
-    anim = mpl.animation.FuncAnimation(game._fig, game.render, frames=game.animate, save_count=args.n_frames, interval=args.frame_interval)
-    anim.save('risk.mp4')
+    # play the game to the end without rendering
+    if args.no_video:
+        player_id = game.play()
+
+        print('Player %d won!' % (player_id))
+
+    # otherwise simulate the frames to render, then render them
+    else:
+        frames = list(itertools.islice(game.simulate(), 0, args.n_frames * args.frame_step, args.frame_step))
+        n_frames = len(frames)
+
+        if args.n_workers > 1:
+            render_video_parallel(game, frames, 'risk.mp4', args.frame_interval, args.dpi, args.n_workers)
+        else:
+            render_video(game, frames, 'risk.mp4', args.frame_interval, args.dpi)
 
     t1 = time.perf_counter()
 
     # print performance metrics
     t = t1 - t0
-    q = args.n_frames / t
-    print('processing time: %.3f s, %.3f frames / s' % (t, q))
+
+    if args.no_video:
+        print('processing time: %.3f s' % (t))
+    else:
+        q = n_frames / t
+        print('processing time: %.3f s, %.3f frames / s' % (t, q))
 
 
 